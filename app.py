@@ -1,6 +1,7 @@
 import gradio as gr
 import pandas as pd
 from datetime import datetime
+from openpyxl import Workbook
 from zoneinfo import ZoneInfo
 
 import calculator
@@ -52,67 +53,125 @@ single_description = f"""
 Instructions for the different inputs:  
 {variable_descriptions}
 """
+# Columns of the uploaded sheet in the order they are passed to the calculator
+calculation_columns = [
+    "PurchaseAmount", "FaceValue", "CouponRate", "CouponFrequency", "FirstCouponAmount",
+    "SettlementDate", "FirstCouponDate", "MaturityDate"
+]
+
+# Types of the non date columns of the uploaded sheet, CouponFrequency is read as a float so that bad values are caught by validation
+input_dtypes = {
+    "BondCode": "string",
+    "PurchaseAmount": "float64",
+    "FaceValue": "float64",
+    "CouponRate": "float64",
+    "CouponFrequency": "float64",
+    "FirstCouponAmount": "float64"
+}
+
+# Header of the summary at the top of each bond's sheet in the processed file
+summary_columns = [
+    "BondCode", "PurchaseAmount", "FaceValue", "CouponRate", "CouponFrequency", "FirstCouponAmount",
+    "SettlementDate", "FirstCouponDate", "MaturityDate", "calculated YTM", "calculated DailyRate"
+]
+
+def frame_to_rows(frame, header=True):
+    '''
+    Turns a DataFrame into a list of its rows as tuples (optionally including the header as the first row) so they can be appended to a sheet
+    '''
+    rows = list(frame.itertuples(index=False, name=None))
+    if header:
+        rows.insert(0, tuple(frame.columns))
+    return rows
+
+def calculate_bonds(bonds):
+    '''
+    Calculates each of the bonds, returning the results and the errors for the bonds that have no solution, both keyed by bond
+    '''
+    results = dict()
+    errors = dict()
+
+    # Each bond only takes a few milliseconds so they are calculated serially, starting worker processes would cost far more
+    for bond in bonds:
+        try:
+            results[bond] = calculator.complete_calculation(*bond)
+        except ValueError as e:
+            errors[bond] = str(e)
+
+    return results, errors
+
 def process_batch_input(file):
-    # Read the uploaded Excel file
-    df = pd.read_excel(file.name)
+    # Read the uploaded Excel file, the schema is fixed so the column types are given rather than inferred
+    df = pd.read_excel(file.name, dtype=input_dtypes)
 
     # Parse date columns
     for col in ["FirstCouponDate", "SettlementDate", "MaturityDate"]:
         df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True)
 
-    problems = list()
-    for index, row in df.iterrows():
-        error = calculator.validate_inputs(row["PurchaseAmount"], row["FaceValue"], row["CouponRate"], row["CouponFrequency"], row["FirstCouponAmount"], row["SettlementDate"], row["FirstCouponDate"], row["MaturityDate"])
-        if error:
-            problems.append(f"Row {index}({row['BondCode']}): {error}")
+    errors = calculator.validate_inputs_df(df)
+    problems = [f"Row {index}({df.at[index, 'BondCode']}): {error}" for index, error in errors.items()]
+
+    if len(problems) > 0:
+        return (None ,"There are problems with the input:\n\n" + "\n".join(problems))
+
+    # Validation has checked the frequency is one of the allowed whole numbers
+    df["CouponFrequency"] = df["CouponFrequency"].astype(int)
+
+    # Pull each column out once as plain python values so the bonds are tuples of scalars rather than pandas rows
+    bonds = list(zip(*(df[column].tolist() for column in calculation_columns)))
+
+    # Repeated bonds only need to be calculated once
+    unique_bonds = list(dict.fromkeys(bonds))
+
+    unique_results, calculation_errors = calculate_bonds(unique_bonds)
 
+    problems = [f"Row {index}({code}): {calculation_errors[bond]}" for index, code, bond in zip(df.index, df["BondCode"], bonds) if bond in calculation_errors]
     if len(problems) > 0:
         return (None ,"There are problems with the input:\n\n" + "\n".join(problems))
 
-    results = [calculator.complete_calculation(row["PurchaseAmount"], row["FaceValue"], row["CouponRate"], row["CouponFrequency"], row["FirstCouponAmount"], row["SettlementDate"], row["FirstCouponDate"], row["MaturityDate"]) for index, row in df.iterrows()]
+    results = [unique_results[bond] for bond in bonds]
 
     output_path = f"{file.name.split('.')[0]}_processed_{datetime.now(tz=ZoneInfo('Pacific/Auckland')).strftime('%Y-%m-%d|%H:%M:%S')}.xlsx"
 
-    with pd.ExcelWriter(output_path) as writer:
-        for (index, row), result in zip(df.iterrows(), results):
-            code = row["BondCode"]
-            summary_df = pd.DataFrame({
-                "BondCode": [code],
-                "PurchaseAmount": [row["PurchaseAmount"]],
-                "FaceValue": [row["FaceValue"]],
-                "CouponRate": [row["CouponRate"]],
-                "CouponFrequency": [row["CouponFrequency"]],
-                "FirstCouponAmount": [row["FirstCouponAmount"]],
-                "SettlementDate": [row["SettlementDate"].strftime('%d/%m/%Y')],
-                "FirstCouponDate": [row["FirstCouponDate"].strftime('%d/%m/%Y')],
-                "MaturityDate": [row["MaturityDate"].strftime('%d/%m/%Y')],
-                "calculated YTM": [result["ytm"]],
-                "calculated DailyRate": [result["daily_rate"]]
-            })
-
-            number_of_rows = len(result['df'])
-
-            formulas_df = pd.DataFrame({
-                "BondCode": "",
-                "PurchaseAmount": f"=sum(B5:B{number_of_rows+5})",
-                "ElapsedDays": "",
-                "CurrentInterest": f"=sum(D5:D{number_of_rows+5})",
-                "CurrentPrincipal": f"=sum(E5:E{number_of_rows+5})",
-                "CumulativeInterest": f"=F{number_of_rows+4}",
-                "ClosingPrincipal": f"=G{number_of_rows+4}",
-                "InterestToBalance": f"=sum(H5:H{number_of_rows+5})"
-            }, index=[0])
-
-            # Clean result date to just be date string
-            result['df']['Date'] = pd.to_datetime(result['df']['Date']).dt.strftime('%d/%m/%Y')
-
-            # Make all other columns calcluated to 2 dp
-            result['df']['ClosingPrincipal'] = result['df']['ClosingPrincipal'].apply(lambda x: round(x, 2))
-            result['df']['InterestToBalance'] = result['df']['InterestToBalance'].apply(lambda x: round(x, 2))
-            
-            summary_df.to_excel(writer, sheet_name=code, index=False)
-            result['df'].to_excel(writer, sheet_name=code, index=False, startrow=3)
-            formulas_df.to_excel(writer, sheet_name=code, index=False, header=False, startrow=number_of_rows+5)
+    # Write only mode streams each sheet to disk as it is written rather than holding the whole workbook in memory
+    workbook = Workbook(write_only=True)
+
+    # Format the input dates for the summaries once for the whole batch
+    date_strings = df[["SettlementDate", "FirstCouponDate", "MaturityDate"]].apply(lambda column: column.dt.strftime('%d/%m/%Y'))
+
+    for code, bond, dates, result in zip(df["BondCode"].tolist(), bonds, date_strings.itertuples(index=False, name=None), results):
+        # Copy as repeated bonds share the same result
+        result_df = result['df'].copy()
+
+        # Clean result date to just be date string
+        result_df['Date'] = result_df['Date'].dt.strftime('%d/%m/%Y')
+
+        # Make all other columns calcluated to 2 dp
+        result_df[['ClosingPrincipal', 'InterestToBalance']] = result_df[['ClosingPrincipal', 'InterestToBalance']].round(2)
+        
+        number_of_rows = len(result_df)
+
+        # Write the summary, data and formulas with a blank row between each
+        sheet = workbook.create_sheet(title=code)
+        sheet.append(summary_columns)
+        # The numeric inputs are the first five of the bond, the dates use their formatted strings
+        sheet.append([code, *bond[:5], *dates, result["ytm"], result["daily_rate"]])
+        sheet.append([])
+        for sheet_row in frame_to_rows(result_df):
+            sheet.append(sheet_row)
+        sheet.append([])
+        sheet.append([
+            "",
+            f"=sum(B5:B{number_of_rows+5})",
+            "",
+            f"=sum(D5:D{number_of_rows+5})",
+            f"=sum(E5:E{number_of_rows+5})",
+            f"=F{number_of_rows+4}",
+            f"=G{number_of_rows+4}",
+            f"=sum(H5:H{number_of_rows+5})"
+        ])
+
+    workbook.save(output_path)
     return (output_path, "No errors, calculation successful!") # Returning file path for download
 
 def process_single_input(purchase_price, face_value, coupon_rate, coupon_frequency, first_coupon_amount, settlement_date, first_coupon_date, maturity_date):
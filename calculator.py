@@ -1,3 +1,5 @@
+import math
+import numpy as np
 import pandas as pd
 import scipy.optimize as opt
 from datetime import datetime
@@ -17,11 +19,18 @@ def generate_payment_dates(start_date, maturity_date, coupon_frequency):
     2. the maturity date is the last payment date
     3. the payment dates are equally spaced
     '''
-    dates = pd.date_range(start=start_date, end=maturity_date, freq=f"{12//coupon_frequency}M", )
-    # Set it to be the same day of the month as the first coupon date
-    dates = list(dates.map(lambda x: x.replace(day=start_date.day) if start_date.day <= x.days_in_month else x))
-
+    start_date = pd.Timestamp(start_date)
     maturity_date = pd.Timestamp(maturity_date)
+
+    # Step from the first of the month so the offset never drifts after a short month
+    months = pd.date_range(start=start_date.replace(day=1), end=maturity_date, freq=pd.DateOffset(months=12//coupon_frequency))
+    # Only include the months that are fully before maturity
+    months = months[months + pd.to_timedelta(months.days_in_month - 1, unit='D') <= maturity_date]
+
+    # Set it to be the same day of the month as the first coupon date, or the end of the month if it is shorter
+    days = np.minimum(start_date.day, months.days_in_month) - 1
+    dates = list(months + pd.to_timedelta(days, unit='D'))
+
     if maturity_date not in dates:
         dates.append(maturity_date)
 
@@ -31,45 +40,48 @@ def populate_cashflows(purchase_price, face_value, coupon_rate, coupon_frequency
     '''
     Takes in the bond details and returns a DataFrame of cashflows with payment dates and elapsed days
     '''
-    cashflows = list()
+    dates = list()
+    cfs = list()
+    elapsed = list()
+
+    def add_cashflow(date, cash_flow, elapsed_days):
+        dates.append(date)
+        cfs.append(cash_flow)
+        elapsed.append(elapsed_days)
 
     payment_amount = calculate_coupon_payment_amount(face_value, coupon_rate, coupon_frequency)
 
     # Payments will be on the same date of the month as the first coupon date. Separated by a fixed number of months.
     payment_dates = generate_payment_dates(first_coupon_date, maturity_date, coupon_frequency)
-    cashflow_dates = [pd.Timestamp(settlement_date)] + payment_dates
+    settlement_date = pd.Timestamp(settlement_date)
+    cashflow_dates = [settlement_date] + payment_dates
+
+    # End of tax year (31st of March) for every year the cashflows can fall in
+    end_of_tax_years = {year: pd.Timestamp(year=year, month=3, day=31) for year in range(settlement_date.year, payment_dates[-1].year + 2)}
 
     for index, payment_date in enumerate(cashflow_dates):
-        elapsed_days = (payment_date - cashflows[-1]["Date"]).days if index > 0 else 0
+        elapsed_days = (payment_date - dates[-1]).days if index > 0 else 0
         if index == 0:
-            cashflows.append({'Date': payment_date, 'Cash Flow': -purchase_price, 'Elapsed Days': elapsed_days})
+            add_cashflow(payment_date, -purchase_price, elapsed_days)
         elif index == 1:
             if first_coupon_amount != 0:
-                cashflows.append({'Date': payment_date, 'Cash Flow': first_coupon_amount, 'Elapsed Days': elapsed_days})
+                add_cashflow(payment_date, first_coupon_amount, elapsed_days)
         elif index == len(cashflow_dates) - 1:
-            cashflows.append({'Date': payment_date, 'Cash Flow': face_value + payment_amount, 'Elapsed Days': elapsed_days})
+            add_cashflow(payment_date, face_value + payment_amount, elapsed_days)
             break
         else:
-            cashflows.append({'Date': payment_date, 'Cash Flow': payment_amount, 'Elapsed Days': elapsed_days})
+            add_cashflow(payment_date, payment_amount, elapsed_days)
 
         # Add in end of tax year if needed
         if index < len(cashflow_dates) - 1:
-            next_end_of_tax_year = pd.Timestamp(f"{payment_date.year}-03-31") if payment_date < pd.Timestamp(f"{payment_date.year}-03-31") else pd.Timestamp(f"{payment_date.year + 1}-03-31")
+            next_end_of_tax_year = end_of_tax_years[payment_date.year] if payment_date < end_of_tax_years[payment_date.year] else end_of_tax_years[payment_date.year + 1]
             if next_end_of_tax_year < cashflow_dates[index+1]:
-                cashflows.append({
-                    'Date': next_end_of_tax_year,
-                    'Cash Flow': 0,
-                    'Elapsed Days': (next_end_of_tax_year - payment_date).days
-                })
+                add_cashflow(next_end_of_tax_year, 0, (next_end_of_tax_year - payment_date).days)
 
-    next_end_of_tax_year = pd.Timestamp(f"{payment_dates[-1].year}-03-31") if payment_dates[-1].month < 3 else pd.Timestamp(f"{payment_dates[-1].year + 1}-03-31")
-    cashflows.append({
-        'Date': next_end_of_tax_year,
-        'Cash Flow': 0,
-        'Elapsed Days': (next_end_of_tax_year - payment_dates[-1]).days
-    })
+    next_end_of_tax_year = end_of_tax_years[payment_dates[-1].year] if payment_dates[-1].month < 3 else end_of_tax_years[payment_dates[-1].year + 1]
+    add_cashflow(next_end_of_tax_year, 0, (next_end_of_tax_year - payment_dates[-1]).days)
 
-    return pd.DataFrame(cashflows).fillna(0)
+    return pd.DataFrame({'Date': dates, 'Cash Flow': cfs, 'Elapsed Days': elapsed})
 
 def calc_daily_rate(ytm, frequency):
     true_rate = (1 + ytm/frequency) ** frequency - 1
@@ -77,59 +89,125 @@ def calc_daily_rate(ytm, frequency):
 
     return daily_rate
 
-def PV_of_cashflow(ytm, cashflows, frequency):
-    daily_rate = calc_daily_rate(ytm, frequency)
-    PV_factor = cashflows.apply(lambda x: (1 + daily_rate) ** (-(x['Date'] - cashflows.loc[0, 'Date']).days), axis=1)
-    PV_of_cashflows = cashflows['Cash Flow'] * PV_factor
-    return PV_of_cashflows.sum()
+def PV_of_cashflow(ytm, days, cf, frequency):
+    '''
+    Present value of the cash flows at the settlement date.
+    days is the number of days from settlement to each cash flow and cf is the cash flow amounts
+    '''
+    # Same as 1 + calc_daily_rate(ytm, frequency) but inlined with scalar math as this is evaluated on every solver iteration
+    daily_growth = math.pow(1 + ytm / frequency, frequency / 365)
+    return (cf * np.power(daily_growth, -days)).sum()
+
+def approximate_ytm(purchase_price, face_value, coupon_rate, settlement_date, maturity_date):
+    '''
+    Approximate yield to maturity, the annual coupon plus the discount spread over the life of the bond as a fraction of the average of the face value and purchase price
+    '''
+    years_to_maturity = (pd.Timestamp(maturity_date) - pd.Timestamp(settlement_date)).days / 365
+    annual_coupon = face_value * coupon_rate
+
+    return (annual_coupon + (face_value - purchase_price) / years_to_maturity) / ((face_value + purchase_price) / 2)
+
+def find_ytm_bracket(days, cf, frequency, first_guess, width=0.01, max_expansions=50):
+    '''
+    Finds a bracket [lower, upper] around the first guess where the PV of the cashflows changes sign so it can be used by brentq
+    The PV decreases as the ytm increases, so:
+    1. the upper bound is moved up by a doubling step until the PV is negative
+    2. the lower bound is moved half way towards -frequency (where the rate is undefined) until the PV is positive
+    '''
+    # Keep the guess in a sensible range as the approximation can be wild for bonds that are very close to maturity
+    first_guess = min(max(first_guess, -0.5), 2.0)
+
+    step = width
+    upper = first_guess + step
+    for _ in range(max_expansions):
+        if PV_of_cashflow(upper, days, cf, frequency) <= 0:
+            break
+        step *= 2
+        upper += step
+    else:
+        raise ValueError("YTM has no solution, the present value of the cash flows is never negative")
+
+    lower = first_guess - width
+    for _ in range(max_expansions):
+        if PV_of_cashflow(lower, days, cf, frequency) >= 0:
+            break
+        lower = (lower - frequency) / 2
+    else:
+        raise ValueError("YTM has no solution, the present value of the cash flows is never positive")
+
+    return lower, upper
 
 def calculate_ytm(cashflows, first_guess, frequency):
+    # Precompute the day offsets and cash flows once so each solver iteration is a pure numpy calculation
+    dates = cashflows['Date'].to_numpy(dtype='datetime64[ns]')
+    days = (dates - dates[0]).astype('timedelta64[D]').astype(np.int64)
+    cf = cashflows['Cash Flow'].to_numpy(dtype=np.float64)
 
-    ytm = opt.fsolve(PV_of_cashflow, first_guess, (cashflows, frequency), xtol=1e-12)
+    lower, upper = find_ytm_bracket(days, cf, frequency, first_guess)
 
-    return ytm[0]
+    # The PV is monotone in the ytm so Brent's method on a bracket converges quickly and reliably
+    return opt.brentq(PV_of_cashflow, lower, upper, args=(days, cf, frequency), xtol=1e-12, maxiter=100)
 
 def populate_interest_principle_columns(cashflows, daily_rate):
-    new_columns = list()
+    '''
+    Adds the interest and principal columns to the cashflows
+    The closing principal follows the recurrence ClosingPrincipal[i] = ClosingPrincipal[i-1] * growth[i] + CashFlow[i]
+    where growth[i] is the daily rate compounded over the elapsed days. This is solved with cumulative products and sums.
+    '''
+    days = cashflows['Elapsed Days'].to_numpy(dtype=np.float64)
+    cf = cashflows['Cash Flow'].to_numpy(dtype=np.float64)
 
-    for index, row in cashflows.iterrows():
-        if index == 0:
-            new_columns.append({
-                "CurrentInterest": 0,
-                "CurrentPrincipal": cashflows.loc[index, 'Cash Flow'],
-                "CumulativeInterest": 0,
-                "ClosingPrincipal": cashflows.loc[index, 'Cash Flow']
-            })
-            continue
-        current_interest = ((1+daily_rate)**cashflows.loc[index, 'Elapsed Days'] - 1) * (-new_columns[- 1]['ClosingPrincipal'])
-        current_principal = cashflows.loc[index, 'Cash Flow'] - current_interest
-        new_columns.append({
-            "CurrentInterest": current_interest,
-            "CurrentPrincipal": current_principal,
-            "CumulativeInterest": new_columns[-1]['CumulativeInterest'] + current_interest,
-            "ClosingPrincipal": new_columns[-1]['ClosingPrincipal'] + current_principal
-        })
-
-    return cashflows.join(pd.DataFrame(new_columns))
+    growth = np.power(1.0 + daily_rate, days)
+    cumulative_growth = np.cumprod(growth)
+    closing_principal = cumulative_growth * np.cumsum(cf / cumulative_growth)
+
+    previous_closing_principal = np.concatenate(([0.0], closing_principal[:-1]))
+    current_interest = (1 - growth) * previous_closing_principal
+
+    return cashflows.assign(
+        CurrentInterest=current_interest,
+        CurrentPrincipal=cf - current_interest,
+        CumulativeInterest=np.cumsum(current_interest),
+        ClosingPrincipal=closing_principal
+    )
 
 def interest_to_balance_data(df):
-    for index, row in df.iterrows():
-        if not (row["Date"].month == 3 and row["Date"].day == 31): # Check if it is the end of a tax year
-            df.loc[index, 'InterestToBalance'] = 0
-            continue
-        
-        df.loc[index, 'InterestToBalance'] = df.loc[index, 'CumulativeInterest'] - df.loc[0:(index-1), 'InterestToBalance'].sum()
+    '''
+    Adds the interest that needs to be balanced at the end of each tax year. This is the cumulative interest less what was balanced
+    in previous tax years, i.e the cumulative interest at this end of tax year less the cumulative interest at the previous one
+    '''
+    is_end_of_tax_year = (df['Date'].dt.month == 3) & (df['Date'].dt.day == 31)
+
+    # Cumulative interest at the last end of tax year before each row
+    previously_balanced = df['CumulativeInterest'].where(is_end_of_tax_year).ffill().shift(1).fillna(0)
+
+    df['InterestToBalance'] = np.where(is_end_of_tax_year, df['CumulativeInterest'] - previously_balanced, 0.0)
 
     return df
 
 def tax_to_declare(df, face_value):
     '''
     Add next to the interest to balance the amount of extra tax that needs to be declared. This is worked out with InterestToBalance - sum(cashflows from tax year)
+    For each row with interest to balance this is InterestToBalance - sum(Cash Flow) - sum(TaxableInterest) + sum(InterestToBalance) over the previous rows
+    (excluding the purchase), plus the face value at maturity. The sum of the previous TaxableInterest cancels out everything before the previous row
+    with interest to balance, so it is just the difference between this row's total and the previous one's.
     '''
-    df['TaxableInterest'] = float(0)
-    for index, row in df.iterrows():
-        if row['InterestToBalance'] != 0:
-            df.loc[index, 'TaxableInterest'] = row['InterestToBalance'] - df.loc[1:(index-1), 'Cash Flow'].sum() - df.loc[1:(index-1), 'TaxableInterest'].sum() + df.loc[1:(index-1), 'InterestToBalance'].sum() + (face_value if index == len(df)-1 else 0)
+    cash_flow = df['Cash Flow'].copy()
+    cash_flow.iloc[0] = 0
+    interest_to_balance = df['InterestToBalance'].copy()
+    interest_to_balance.iloc[0] = 0
+
+    # Sums over the previous rows are exclusive cumulative sums
+    previous_cash_flow = cash_flow.cumsum() - cash_flow
+    previous_interest_to_balance = interest_to_balance.cumsum() - interest_to_balance
+
+    total = df['InterestToBalance'] - previous_cash_flow + previous_interest_to_balance
+    total.iloc[-1] += face_value
+
+    has_interest_to_balance = df['InterestToBalance'] != 0
+    previous_total = total.where(has_interest_to_balance).ffill().shift(1).fillna(0)
+
+    df['TaxableInterest'] = np.where(has_interest_to_balance, total - previous_total, 0.0)
 
     return df
 
@@ -137,7 +215,9 @@ def tax_to_declare(df, face_value):
 def complete_calculation(purchase_price, face_value, coupon_rate, coupon_frequency, first_coupon_amount, settlement_date, first_coupon_date, maturity_date):
     cashflows = populate_cashflows(purchase_price, face_value, coupon_rate, coupon_frequency, first_coupon_amount, settlement_date, first_coupon_date, maturity_date)
 
-    ytm = calculate_ytm(cashflows, coupon_rate, coupon_frequency)
+    first_guess = approximate_ytm(purchase_price, face_value, coupon_rate, settlement_date, maturity_date)
+
+    ytm = calculate_ytm(cashflows, first_guess, coupon_frequency)
 
     daily_rate = calc_daily_rate(ytm, coupon_frequency)
 
@@ -154,14 +234,19 @@ def complete_calculation(purchase_price, face_value, coupon_rate, coupon_frequen
     }
 
 def validate_inputs(purchase_price, face_value, coupon_rate, coupon_frequency, first_coupon_amount, settlement_date, first_coupon_date, maturity_date):
-    
+
+    # Check for missing values explicitly, a first coupon amount of 0 is valid so truthiness can't be used
+    for name, value in [("Purchase price", purchase_price), ("Face value", face_value), ("Coupon rate", coupon_rate), ("Coupon frequency", coupon_frequency), ("First coupon amount", first_coupon_amount)]:
+        if value is None or pd.isna(value):
+            return f"{name} is missing"
+
     if purchase_price <= 0:
         return "Purchase price must be greater than 0"
 
     if face_value <= 0:
         return "Face value must be greater than 0"
 
-    if coupon_rate <= 0 and coupon_rate >= 1:
+    if coupon_rate <= 0 or coupon_rate >= 1:
         return "Coupon rate must be greater than 0 and less than 1"
 
     if coupon_frequency not in [1,2,4,6,12]:
@@ -171,11 +256,11 @@ def validate_inputs(purchase_price, face_value, coupon_rate, coupon_frequency, f
         return "First coupon amount cannot be negative"
 
     try:
-        if settlement_date is pd.NaT:
+        if pd.isna(settlement_date):
             return "Settlement date is malformed"
-        if first_coupon_date is pd.NaT:
+        if pd.isna(first_coupon_date):
             return "First coupon date is malformed"
-        if maturity_date is pd.NaT:
+        if pd.isna(maturity_date):
             return "Maturity date is malformed"
 
         # Validate chronological order of dates
@@ -183,8 +268,41 @@ def validate_inputs(purchase_price, face_value, coupon_rate, coupon_frequency, f
             return "Settlement date must be before first coupon date"
         if first_coupon_date > maturity_date:
             return "First coupon date must be before maturity date"
+        if settlement_date >= maturity_date:
+            return "Settlement date must be before maturity date"
 
     except Exception as e:
         return f"Date validation error: {e}"
 
-    return None
\ No newline at end of file
+    return None
+
+def validate_inputs_df(df):
+    '''
+    Validates all of the bonds in a batch DataFrame at once with the same checks as validate_inputs
+    Returns a Series of the error message for each row that has a problem, indexed by the row
+    '''
+    # Checks in the same order as validate_inputs so each row reports its first problem
+    checks = [
+        (df['PurchaseAmount'].isna(), "Purchase price is missing"),
+        (df['FaceValue'].isna(), "Face value is missing"),
+        (df['CouponRate'].isna(), "Coupon rate is missing"),
+        (df['CouponFrequency'].isna(), "Coupon frequency is missing"),
+        (df['FirstCouponAmount'].isna(), "First coupon amount is missing"),
+        (df['PurchaseAmount'] <= 0, "Purchase price must be greater than 0"),
+        (df['FaceValue'] <= 0, "Face value must be greater than 0"),
+        ((df['CouponRate'] <= 0) | (df['CouponRate'] >= 1), "Coupon rate must be greater than 0 and less than 1"),
+        (~df['CouponFrequency'].isin([1,2,4,6,12]), "Coupon frequency must be one of 1, 2, 4, 6, or 12"),
+        (df['FirstCouponAmount'] < 0, "First coupon amount cannot be negative"),
+        (df['SettlementDate'].isna(), "Settlement date is malformed"),
+        (df['FirstCouponDate'].isna(), "First coupon date is malformed"),
+        (df['MaturityDate'].isna(), "Maturity date is malformed"),
+        (df['SettlementDate'] > df['FirstCouponDate'], "Settlement date must be before first coupon date"),
+        (df['FirstCouponDate'] > df['MaturityDate'], "First coupon date must be before maturity date"),
+        (df['SettlementDate'] >= df['MaturityDate'], "Settlement date must be before maturity date")
+    ]
+    conditions = [mask.fillna(False).to_numpy(dtype=bool) for mask, _ in checks]
+
+    bad_rows = np.where(np.logical_or.reduce(conditions))[0]
+    errors = np.select([condition[bad_rows] for condition in conditions], [message for _, message in checks], default="")
+
+    return pd.Series(errors, index=df.index[bad_rows], dtype=object)